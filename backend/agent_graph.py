@@ -1,11 +1,16 @@
 from __future__ import annotations
 
-
-from typing import AsyncIterator, List, Optional, TypedDict
-
-from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, SystemMessage
+import asyncio
+import base64
+import io
+import logging
+from typing import Annotated, Any, AsyncIterator, Dict, List, Optional, TypedDict
+
+import httpx
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
 from langchain_ollama import ChatOllama
 from langgraph.graph import END, START, StateGraph
+from langgraph.graph.message import add_messages
 from pydantic import Field
 from pydantic_settings import BaseSettings
 
@@ -15,44 +20,99 @@ class Settings(BaseSettings):
     vlm_model: str = Field(default="hf.co/unsloth/medgemma-27b-it-GGUF:Q4_K_M")
     llm_model: str = Field(default="llama3.1:latest")
     request_timeout_seconds: float = Field(default=180.0, gt=0)
+    ollama_keep_alive: str = Field(default="24h")
+    http_max_connections: int = Field(default=100, gt=0)
+    http_max_keepalive_connections: int = Field(default=40, ge=0)
+    http_keepalive_expiry_seconds: float = Field(default=30.0, ge=0)
+    stream_flush_interval_ms: float = Field(default=30.0, gt=0)
+    stream_max_batch_tokens: int = Field(default=50, gt=0)
 
 
 settings = Settings()
 
+logger = logging.getLogger("backend")
+
 
 class AgentState(TypedDict):
-    messages: List[BaseMessage]
-    image_data: Optional[str]
+    messages: Annotated[List[BaseMessage], add_messages]
+    image_path: Optional[str]
     medical_report: Optional[str]
     final_answer: Optional[str]
+    user_prompt: Optional[str]
 
 
+# Both agents talk to the same Ollama host; keep their HTTP pools warm so streamed
+# requests reuse open connections instead of reconnecting on every call.
+ollama_client_kwargs = {
+    # ChatOllama has no timeout field of its own; the ollama client forwards this to httpx.
+    "timeout": httpx.Timeout(settings.request_timeout_seconds, connect=10.0),
+    "limits": httpx.Limits(
+        max_connections=settings.http_max_connections,
+        max_keepalive_connections=settings.http_max_keepalive_connections,
+        keepalive_expiry=settings.http_keepalive_expiry_seconds,
+    ),
+}
+
 radiologist_llm = ChatOllama(
     model=settings.vlm_model,
     base_url=settings.ollama_base_url,
     temperature=0,
-    timeout=settings.request_timeout_seconds,
+    keep_alive=settings.ollama_keep_alive,
+    client_kwargs=ollama_client_kwargs,
 )
 
 doctor_llm = ChatOllama(
     model=settings.llm_model,
     base_url=settings.ollama_base_url,
     temperature=0,
-    timeout=settings.request_timeout_seconds,
+    keep_alive=settings.ollama_keep_alive,
+    client_kwargs=ollama_client_kwargs,
 )
 
+# Same models and connection pools as the agents, but generating a single token: used to load the
+# models at startup and to prefill the doctor's prompt prefix while the radiologist is still streaming.
+radiologist_warmup_llm = radiologist_llm.model_copy(update={"num_predict": 1})
+doctor_warmup_llm = doctor_llm.model_copy(update={"num_predict": 1})
 
-def _chunk_text(content: str | List[dict] | None) -> str:
-    """Extracts plain text from a streamed chunk."""
-    if isinstance(content, str):
-        return content
-    if isinstance(content, list):
-        parts = []
-        for item in content:
-            if isinstance(item, dict) and item.get("type") == "text" and item.get("text"):
-                parts.append(item["text"])
-        return "".join(parts)
-    return ""
+# Multiple of 3 so each chunk base64-encodes without padding and the pieces concatenate cleanly.
+IMAGE_READ_CHUNK_BYTES = 57_000
+
+# Static prompt pieces are built once; message objects are never mutated, so they are shared across requests.
+_RADIOLOGIST_INSTRUCTION = {
+    "type": "text",
+    "text": (
+        "You are a medical imaging analyst. Analyze the provided medical image in detail. "
+        "Focus on clinically relevant findings, note uncertainties, and avoid speculation."
+    ),
+}
+
+_DOCTOR_SYSTEM = SystemMessage(content="You are a careful medical doctor. Avoid overconfident claims.")
+
+_DOCTOR_ROLE = "You are the attending physician speaking directly to the user."
+_DOCTOR_GUIDANCE = "State any uncertainties and next steps the user can consider."
+
+
+def _doctor_instruction(sources: str) -> str:
+    """Builds the doctor's instruction around what it is asked to review."""
+    return f"{_DOCTOR_ROLE} Review {sources} and give a clear, plain-language answer with bullet points. {_DOCTOR_GUIDANCE}"
+
+
+_DOCTOR_INSTRUCTION = _doctor_instruction("the clinician's question and the imaging report")
+_DOCTOR_TEXT_ONLY_INSTRUCTION = _doctor_instruction("the clinician's question")
+
+_DOCTOR_TAIL = "Respond succinctly and conversationally; avoid AI-style disclaimers."
+
+
+def _chunk_text_str(content: str) -> str:
+    """Extracts plain text from a streamed chunk whose content is a string."""
+    return content
+
+
+def _chunk_text_list(content: List[dict]) -> str:
+    """Extracts plain text from a streamed chunk whose content is a list of parts."""
+    return "".join(
+        item["text"] for item in content if isinstance(item, dict) and item.get("type") == "text" and item.get("text")
+    )
 
 
 def _extract_user_prompt(messages: List[BaseMessage]) -> str:
@@ -63,77 +123,111 @@ def _extract_user_prompt(messages: List[BaseMessage]) -> str:
             if isinstance(content, str):
                 return content
             if isinstance(content, list):
-                text_parts = [part.get("text") for part in content if isinstance(part, dict) and part.get("type") == "text"]
-                return "\n".join([part for part in text_parts if part])
+                return "\n".join(
+                    part["text"] for part in content if isinstance(part, dict) and part.get("type") == "text" and part.get("text")
+                )
     return ""
 
 
-def _create_radiologist_messages(state: AgentState) -> List[BaseMessage]:
+def _get_user_prompt(state: AgentState) -> str:
+    """
+    Returns the latest user prompt, scanning the message history only once per turn.
+
+    The cached value is cleared when a turn ends (see doctor_node), so a state carried into the
+    next turn picks up the new human message instead of answering the previous question.
+    """
+    user_prompt = state.get("user_prompt")
+    if user_prompt is None:
+        user_prompt = _extract_user_prompt(state["messages"])
+        state["user_prompt"] = user_prompt
+    return user_prompt
+
+
+def _encode_image_file(image_path: str) -> str:
+    """Base64-encode an image file chunk by chunk without loading it whole."""
+    out = io.BytesIO()
+    with open(image_path, "rb") as source:
+        while chunk := source.read(IMAGE_READ_CHUNK_BYTES):
+            out.write(base64.b64encode(chunk))
+    return out.getvalue().decode("ascii")
+
+
+def _create_radiologist_messages(state: AgentState, image_b64: Optional[str]) -> List[BaseMessage]:
     """Helper to construct messages for the radiologist agent."""
-    image_data = state.get("image_data")
-    user_prompt = _extract_user_prompt(state["messages"])
-
-    human_content = [
-        {
-            "type": "text",
-            "text": (
-                "You are a medical imaging analyst. Analyze the provided medical image in detail. "
-                "Focus on clinically relevant findings, note uncertainties, and avoid speculation."
-            ),
-        }
-    ]
+    user_prompt = _get_user_prompt(state)
+
+    human_content = [_RADIOLOGIST_INSTRUCTION]
 
     if user_prompt:
         human_content.append({"type": "text", "text": f"Clinician question: {user_prompt}"})
 
-    if image_data:
-        human_content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}})
+    if image_b64:
+        human_content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}})
 
     return [HumanMessage(content=human_content)]
 
 
 def _create_doctor_messages(state: AgentState) -> List[BaseMessage]:
     """Helper to construct messages for the doctor agent."""
-    user_prompt = _extract_user_prompt(state["messages"])
-    medical_report = state.get("medical_report") or "No imaging report was generated."
+    user_prompt = _get_user_prompt(state)
 
-    prompt = (
-        "You are the attending physician speaking directly to the user. "
-        "Review the clinician's question and the imaging report and give a clear, plain-language answer with bullet points. "
-        "State any uncertainties and next steps the user can consider.\n\n"
-        f"Clinician question:\n{user_prompt}\n\n"
-        f"Imaging report:\n{medical_report}\n\n"
-        "Respond succinctly and conversationally; avoid AI-style disclaimers."
+    if not state.get("image_path") and not state.get("medical_report"):
+        # Text-only case: leave out the imaging section entirely rather than prefilling a placeholder.
+        prompt = "\n\n".join((_DOCTOR_TEXT_ONLY_INSTRUCTION, f"Clinician question:\n{user_prompt}", _DOCTOR_TAIL))
+        return [_DOCTOR_SYSTEM, HumanMessage(content=prompt)]
+
+    medical_report = state.get("medical_report") or "No imaging report was generated."
+    prompt = "\n\n".join(
+        (
+            _doctor_prompt_prefix(user_prompt),
+            f"Imaging report:\n{medical_report}",
+            _DOCTOR_TAIL,
+        )
     )
 
-    return [
-        SystemMessage(content="You are a careful medical doctor. Avoid overconfident claims."),
-        HumanMessage(content=prompt),
-    ]
+    return [_DOCTOR_SYSTEM, HumanMessage(content=prompt)]
+
+
+def _doctor_prompt_prefix(user_prompt: str) -> str:
+    """The part of the doctor prompt that is known before the imaging report exists."""
+    return f"{_DOCTOR_INSTRUCTION}\n\nClinician question:\n{user_prompt}"
+
+
+def _create_doctor_warmup_messages(state: AgentState) -> List[BaseMessage]:
+    """
+    Helper to construct the throwaway prompt used to prefill the doctor model.
+
+    Its text matches the start of the final doctor prompt exactly, so Ollama's prompt cache lets
+    the real request skip prefilling everything up to the imaging report.
+    """
+    return [_DOCTOR_SYSTEM, HumanMessage(content=_doctor_prompt_prefix(_get_user_prompt(state)))]
 
 
-def radiologist_node(state: AgentState) -> AgentState:
+def radiologist_node(state: AgentState) -> Dict[str, Any]:
     """Runs the vision model when an image is present to produce a medical report."""
-    messages = _create_radiologist_messages(state)
+    image_b64 = _encode_image_file(state["image_path"]) if state.get("image_path") else None
+    messages = _create_radiologist_messages(state, image_b64)
     response = radiologist_llm.invoke(messages)
 
-    updated_messages = [*state["messages"], response] if isinstance(response, AIMessage) else state["messages"]
+    # Return only the new message; the add_messages reducer appends it to the history.
+    new_messages = [response] if isinstance(response, AIMessage) else []
 
-    return {**state, "messages": updated_messages, "medical_report": response.content}
+    return {"messages": new_messages, "medical_report": response.content, "user_prompt": _get_user_prompt(state)}
 
 
-def doctor_node(state: AgentState) -> AgentState:
+def doctor_node(state: AgentState) -> Dict[str, Any]:
     """Synthesizes the user query and medical report into a final answer."""
     messages = _create_doctor_messages(state)
     response = doctor_llm.invoke(messages)
-    updated_messages = [*state["messages"], response] if isinstance(response, AIMessage) else state["messages"]
+    new_messages = [response] if isinstance(response, AIMessage) else []
 
-    return {**state, "messages": updated_messages, "final_answer": response.content}
+    # The doctor ends the turn; drop the cached prompt so the next human message is re-read.
+    return {"messages": new_messages, "final_answer": response.content, "user_prompt": None}
 
 
 def router(state: AgentState) -> str:
     """Route to the radiologist if an image is present and no report exists; otherwise go to the doctor."""
-    if state.get("image_data") and not state.get("medical_report"):
+    if state.get("image_path") and not state.get("medical_report"):
         return "radiologist"
     return "doctor"
 
@@ -149,37 +243,68 @@ medical_graph = graph.compile()
 
 
 # --- Streaming helpers for SSE ---
-async def _stream_radiologist(state: AgentState) -> AsyncIterator[dict]:
-    """Stream radiologist (VLM) tokens and update state."""
-    messages = _create_radiologist_messages(state)
+async def _astream_text(llm: ChatOllama, messages: List[BaseMessage]) -> AsyncIterator[str]:
+    """Stream non-empty text tokens from a chat model."""
+    extract = None
+    # ChatOllama.astream only yields AIMessageChunk, so the content is read without a per-chunk type check.
+    async for chunk in llm.astream(messages):
+        content = chunk.content
+        if extract is None:
+            # Providers keep one content shape for a whole stream, so dispatch once.
+            extract = _chunk_text_str if isinstance(content, str) else _chunk_text_list
+        token = extract(content)
+        if token:
+            yield token
 
-    report = ""
-    async for chunk in radiologist_llm.astream(messages):
-        if isinstance(chunk, AIMessageChunk):
-            token = _chunk_text(chunk.content)
-            if token:
-                report += token
-                yield {"event": "vlm_token", "token": token}
 
+async def _stream_radiologist(state: AgentState) -> AsyncIterator[dict]:
+    """Stream radiologist (VLM) tokens and update state."""
+    image_b64 = None
+    if state.get("image_path"):
+        # Reading and encoding is blocking; keep it off the event loop so other streams stay responsive.
+        image_b64 = await asyncio.to_thread(_encode_image_file, state["image_path"])
+    messages = _create_radiologist_messages(state, image_b64)
+
+    report_parts: List[str] = []
+    async for token in _astream_text(radiologist_llm, messages):
+        report_parts.append(token)
+        yield {"event": "vlm_token", "token": token}
+
+    report = "".join(report_parts)
     state["medical_report"] = report
-    state["messages"] = [*state["messages"], AIMessage(content=report)]
-
+    state["messages"].append(AIMessage(content=report))
 
 
 async def _stream_doctor(state: AgentState) -> AsyncIterator[dict]:
     """Stream doctor (LLM) tokens and update state."""
     messages = _create_doctor_messages(state)
 
-    answer = ""
-    async for chunk in doctor_llm.astream(messages):
-        if isinstance(chunk, AIMessageChunk):
-            token = _chunk_text(chunk.content)
-            if token:
-                answer += token
-                yield {"event": "llm_token", "token": token}
+    answer_parts: List[str] = []
+    async for token in _astream_text(doctor_llm, messages):
+        answer_parts.append(token)
+        yield {"event": "llm_token", "token": token}
 
+    answer = "".join(answer_parts)
     state["final_answer"] = answer
-    state["messages"] = [*state["messages"], AIMessage(content=answer)]
+    state["messages"].append(AIMessage(content=answer))
+
+
+async def _warm_doctor(state: AgentState) -> None:
+    """Preload and prefill the doctor model; failures only cost the overlap, so they are logged and dropped."""
+    try:
+        await doctor_warmup_llm.ainvoke(_create_doctor_warmup_messages(state))
+    except Exception:
+        logger.warning("Doctor warmup failed; continuing without it.", exc_info=True)
+
+
+async def warm_models() -> None:
+    """Load both agent models into Ollama so the first request does not pay the model-load time."""
+    for llm in (radiologist_warmup_llm, doctor_warmup_llm):
+        try:
+            await llm.ainvoke([HumanMessage(content="ping")])
+            logger.info("Warmed model %s.", llm.model)
+        except Exception:
+            logger.warning("Warmup of model %s failed.", llm.model, exc_info=True)
 
 
 async def stream_agent_events(initial_state: AgentState) -> AsyncIterator[dict]:
@@ -187,14 +312,27 @@ async def stream_agent_events(initial_state: AgentState) -> AsyncIterator[dict]:
     Drive the agentic workflow with streaming tokens for SSE.
 
     Yields event payloads compatible with the existing frontend stream handler.
+    Agent replies are appended in place to ``initial_state["messages"]``.
     """
     state = {**initial_state}
-
-    if state.get("image_data") and not state.get("medical_report"):
-        async for payload in _stream_radiologist(state):
+    # Resolve the prompt once up front, ignoring any value carried over from a previous turn;
+    # both agents' prompt builders reuse it.
+    state["user_prompt"] = _extract_user_prompt(state["messages"])
+    warmup: Optional[asyncio.Task] = None
+
+    try:
+        if state.get("image_path") and not state.get("medical_report"):
+            # The doctor cannot answer before the report is final, but its model load and
+            # prompt prefill can overlap with the radiologist's decoding.
+            warmup = asyncio.create_task(_warm_doctor(state))
+            async for payload in _stream_radiologist(state):
+                yield payload
+            await warmup
+
+        async for payload in _stream_doctor(state):
             yield payload
-
-    async for payload in _stream_doctor(state):
-        yield payload
+    finally:
+        if warmup is not None and not warmup.done():
+            warmup.cancel()
 
     yield {"event": "done", "vlm_output": state.get("medical_report"), "llm_report": state.get("final_answer")}
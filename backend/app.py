@@ -1,21 +1,38 @@
 from __future__ import annotations
 
-import base64
-import json
+import asyncio
 import logging
-from typing import AsyncIterator, Dict, Optional
+import shutil
+import tempfile
+import uuid
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional
 
+import orjson
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from langchain_core.messages import HumanMessage
 from sse_starlette.sse import EventSourceResponse
+from starlette.background import BackgroundTask
 
-from agent_graph import AgentState, stream_agent_events
+from agent_graph import AgentState, settings, stream_agent_events, warm_models
 
 logger = logging.getLogger("backend")
 logging.basicConfig(level=logging.INFO)
 
-app = FastAPI(title="Medical Pipeline API", version="1.0.0")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    # Warm in the background so the API (and /healthz) is up while the models load.
+    warmup = asyncio.create_task(warm_models())
+    try:
+        yield
+    finally:
+        warmup.cancel()
+
+
+app = FastAPI(title="Medical Pipeline API", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -25,6 +42,129 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Uploads are spooled to disk and handed to the agents by path, so the base64 copy only
+# exists while the radiologist request is being built.
+IMAGE_SPOOL_DIR = Path(tempfile.gettempdir()) / "mai-images"
+IMAGE_COPY_CHUNK_BYTES = 1024 * 1024
+
+# Error frames carry a short single-line summary; the full traceback goes to the log.
+ERROR_MESSAGE_MAX_CHARS = 512
+
+TOKEN_EVENTS = frozenset({"vlm_token", "llm_token"})
+# Token frames have a fixed shape, so only the token string itself needs encoding.
+TOKEN_FRAME_PREFIXES = {event: f'{{"event":"{event}","token":' for event in TOKEN_EVENTS}
+# Token batches start small so the first tokens go out immediately, then grow
+# geometrically up to the configured cap once the stream is flowing.
+MIN_BATCH_TOKENS = 1
+BATCH_GROWTH_FACTOR = 3
+
+
+async def _coalesce_tokens(events: AsyncIterator[dict]) -> AsyncIterator[dict]:
+    """
+    Merge consecutive token events into fewer, larger payloads.
+
+    A pending batch is flushed when it reaches its size limit, when the flush interval
+    elapses, or when an event of another type arrives, so event ordering is preserved.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    end_of_stream = object()
+
+    async def pump() -> None:
+        # The queue is unbounded, so put_nowait never blocks and is safe while unwinding.
+        try:
+            async for payload in events:
+                await queue.put(payload)
+        except asyncio.CancelledError:
+            # Raised by our own cleanup, or out of the upstream itself (e.g. a cancelled inner task);
+            # in the latter case the consumer is still waiting and should end with an error frame.
+            queue.put_nowait(RuntimeError("Agent stream was cancelled."))
+            raise
+        except Exception as exc:
+            queue.put_nowait(exc)
+        finally:
+            queue.put_nowait(end_of_stream)
+
+    producer = asyncio.create_task(pump())
+    flush_interval = settings.stream_flush_interval_ms / 1000
+    batch_limits: Dict[str, int] = {}
+    pending_event: Optional[str] = None
+    pending: List[str] = []
+    deadline = 0.0
+
+    def flush() -> dict:
+        nonlocal pending_event
+        payload = {"event": pending_event, "token": "".join(pending)}
+        limit = batch_limits.get(pending_event, MIN_BATCH_TOKENS)
+        batch_limits[pending_event] = min(limit * BATCH_GROWTH_FACTOR, settings.stream_max_batch_tokens)
+        pending_event = None
+        pending.clear()
+        return payload
+
+    try:
+        while True:
+            if pending:
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    yield flush()
+                    continue
+            else:
+                item = await queue.get()
+
+            # Tokens already received go out before the stream ends, whether it ends cleanly or not.
+            if item is end_of_stream or isinstance(item, Exception):
+                if pending:
+                    yield flush()
+                if item is end_of_stream:
+                    break
+                raise item
+
+            is_token = item.get("event") in TOKEN_EVENTS
+            if pending and (not is_token or item["event"] != pending_event):
+                yield flush()
+            if not is_token:
+                yield item
+                continue
+
+            if not pending:
+                pending_event = item["event"]
+                deadline = loop.time() + flush_interval
+            pending.append(item["token"])
+            if len(pending) >= batch_limits.get(pending_event, MIN_BATCH_TOKENS):
+                yield flush()
+    finally:
+        if not producer.done():
+            producer.cancel()
+
+
+def _encode_event(payload: dict) -> str:
+    """Serialize an event payload into the JSON body of one SSE frame."""
+    prefix = TOKEN_FRAME_PREFIXES.get(payload.get("event"))
+    if prefix is not None:
+        return prefix + orjson.dumps(payload["token"]).decode() + "}"
+    return orjson.dumps(payload).decode()
+
+
+def _error_event(exc: Exception) -> dict:
+    """Build a compact, single-line error payload for the client."""
+    message = " ".join(str(exc).split())[:ERROR_MESSAGE_MAX_CHARS]
+    return {"event": "error", "message": message or type(exc).__name__}
+
+
+def _spool_upload(source: BinaryIO) -> Path:
+    """Copy an uploaded file into the image spool directory and return its path."""
+    IMAGE_SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    image_path = IMAGE_SPOOL_DIR / f"{uuid.uuid4().hex}.jpg"
+    try:
+        with image_path.open("wb") as out:
+            shutil.copyfileobj(source, out, IMAGE_COPY_CHUNK_BYTES)
+    except BaseException:
+        # Don't leave a partial file behind in the spool directory.
+        image_path.unlink(missing_ok=True)
+        raise
+    return image_path
+
 
 @app.get("/healthz")
 async def healthcheck() -> Dict[str, str]:
@@ -36,29 +176,35 @@ async def analyze_case(
     prompt: str = Form(..., min_length=0, max_length=2000),
     image: Optional[UploadFile] = File(default=None),
 ) -> EventSourceResponse:
-    image_b64: Optional[str] = None
+    image_path: Optional[Path] = None
 
     if image:
-        content = await image.read()
-        if not content:
+        # Disk I/O runs in a worker thread so other streams stay responsive.
+        image_path = await asyncio.to_thread(_spool_upload, image.file)
+        if image_path.stat().st_size == 0:
+            image_path.unlink(missing_ok=True)
             raise HTTPException(status_code=400, detail="Uploaded image is empty.")
-        image_b64 = base64.b64encode(content).decode("utf-8")
 
     async def event_stream() -> AsyncIterator[str]:
         try:
-            yield json.dumps({"event": "status", "state": "processing"})
+            yield _encode_event({"event": "status", "state": "processing"})
 
             initial_state: AgentState = {
                 "messages": [HumanMessage(content=prompt)],
-                "image_data": image_b64,
+                "image_path": str(image_path) if image_path else None,
                 "medical_report": None,
                 "final_answer": None,
+                "user_prompt": None,
             }
 
-            async for payload in stream_agent_events(initial_state):
-                yield json.dumps(payload)
+            async for payload in _coalesce_tokens(stream_agent_events(initial_state)):
+                yield _encode_event(payload)
         except Exception as exc:
             logger.exception("Streaming workflow failed.")
-            yield json.dumps({"event": "error", "message": str(exc)})
+            # The error frame ends the stream; a trailing "done" would make the client replace
+            # the error with its (partial) answer buffer.
+            yield _encode_event(_error_event(exc))
 
-    return EventSourceResponse(event_stream(), media_type="text/event-stream")
+    # Runs once the response finishes, even if the client disconnects before the body is streamed.
+    cleanup = BackgroundTask(image_path.unlink, missing_ok=True) if image_path else None
+    return EventSourceResponse(event_stream(), media_type="text/event-stream", background=cleanup)
@@ -1,10 +1,24 @@
 from __future__ import annotations
 
+import hashlib
+import importlib.util
 from pathlib import Path
 
+from langchain_core.runnables.graph import Graph, MermaidDrawMethod
+
 from agent_graph import medical_graph
 
 
+def _render_png(graph: Graph) -> bytes:
+    """Render locally when pyppeteer works; otherwise fall back to the mermaid.ink API."""
+    if importlib.util.find_spec("pyppeteer"):
+        try:
+            return graph.draw_mermaid_png(draw_method=MermaidDrawMethod.PYPPETEER)
+        except Exception as exc:  # pragma: no cover - e.g. no Chromium downloaded
+            print(f"⚠️  Local Mermaid render failed, falling back to mermaid.ink. Reason: {exc}")
+    return graph.draw_mermaid_png(draw_method=MermaidDrawMethod.API)
+
+
 def main() -> None:
     graph = medical_graph.get_graph()
 
@@ -13,9 +27,15 @@ def main() -> None:
     mermaid_path.write_text(mermaid_text, encoding="utf-8")
     print(f"✅ Mermaid diagram written to: {mermaid_path}")
 
-    png_path = Path(__file__).parent / "medical_graph.png"
+    # Key the PNG on the diagram source so an unchanged graph is never re-rendered.
+    digest = hashlib.sha256(mermaid_text.encode("utf-8")).hexdigest()[:12]
+    png_path = Path(__file__).parent / f"medical_graph.{digest}.png"
+    if png_path.exists():
+        print(f"✅ PNG diagram up to date: {png_path}")
+        return
+
     try:
-        png_bytes = graph.draw_mermaid_png()
+        png_bytes = _render_png(graph)
         png_path.write_bytes(png_bytes)
         print(f"✅ PNG diagram written to: {png_path}")
     except Exception as exc:  # pragma: no cover - best-effort rendering
@@ -1,51 +1,155 @@
 import base64
-import json
 import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import singledispatch
 from pathlib import Path
-from typing import Any, Dict, Iterable, Optional, Union
+from typing import Any, Dict, Iterable, List, Optional, Set, Union
 
-from datasets import Dataset, DatasetDict, Image, IterableDataset, load_dataset
+import orjson
+from datasets import Dataset, DatasetDict, Image, IterableDataset, Value, load_dataset
 
+# Serialized rows are buffered and written in blocks of this size to cut write syscalls.
+WRITE_BUFFER_BYTES = 4 * 1024 * 1024
+# Image files are written by a small thread pool while the main thread serializes rows.
+IMAGE_WRITE_WORKERS = 8
 
+
+@singledispatch
 def _clean_value(value: Any) -> Any:
     """
     Ensure strings are valid UTF-8; drop/replace problematic bytes.
     """
-    if isinstance(value, str):
-        return value.encode("utf-8", errors="replace").decode("utf-8")
-    if isinstance(value, bytes):
-        # Encode binary payloads when present (should be rare after image handling).
-        return base64.b64encode(value).decode("ascii")
-    if isinstance(value, Path):
-        return str(value)
-    if isinstance(value, list):
-        return [_clean_value(v) for v in value]
-    if isinstance(value, dict):
-        return {k: _clean_value(v) for k, v in value.items()}
     return value
 
 
+@_clean_value.register
+def _(value: str) -> str:
+    # ASCII text cannot hold lone surrogates, so only non-ASCII strings need the round-trip.
+    if value.isascii():
+        return value
+    return value.encode("utf-8", errors="replace").decode("utf-8")
+
+
+@_clean_value.register
+def _(value: bytes) -> str:
+    # Encode binary payloads when present (should be rare after image handling).
+    return base64.b64encode(value).decode("ascii")
+
+
+@_clean_value.register
+def _(value: Path) -> str:
+    return str(value)
+
+
+@_clean_value.register
+def _(value: list) -> list:
+    return [_clean_value(v) for v in value]
+
+
+@_clean_value.register
+def _(value: dict) -> dict:
+    return {k: _clean_value(v) for k, v in value.items()}
+
+
+def _write_image_bytes(image_out: Path, data: bytes) -> None:
+    """
+    Write image bytes to a new file; leave an existing file untouched.
+    """
+    try:
+        fd = os.open(image_out, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        return
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def _extract_image(row: Dict[str, Any], idx: int, image_dir: Path, output_root: Path) -> Dict[str, Optional[str]]:
+    """
+    Write one row's image to disk and return its path relative to the JSONL file.
+    """
+    image_info = row["image"]
+    if not isinstance(image_info, dict):
+        return {"image": image_info}
+    image_name = image_info.get("path") or f"image_{idx}.jpg"
+    image_out = image_dir / image_name
+    if image_out.parent != image_dir:
+        image_out.parent.mkdir(parents=True, exist_ok=True)
+    if image_info.get("bytes"):
+        _write_image_bytes(image_out, image_info["bytes"])
+    # Store relative path in JSON for portability.
+    return {"image": str(image_out.relative_to(output_root))}
+
+
 def _write_jsonl(
     split_ds: Union[Dataset, IterableDataset],
     split_path: Path,
     image_dir: Optional[Path],
 ) -> None:
-    with split_path.open("w", encoding="utf-8") as f:
+    if not isinstance(split_ds, Dataset):
+        _write_jsonl_rows(split_ds, split_path, image_dir)
+        return
+
+    # Materialized datasets are written by datasets' own Arrow -> JSON writer instead of a per-row loop.
+    if image_dir:
+        image_dir.mkdir(parents=True, exist_ok=True)
+        features = split_ds.features.copy()
+        features["image"] = Value("string")
+        split_ds = split_ds.map(
+            _extract_image,
+            with_indices=True,
+            fn_kwargs={"image_dir": image_dir, "output_root": split_path.parent},
+            remove_columns=["image"],
+            features=features,
+            # Decoding and writing images is independent per row, so spread it across all cores.
+            num_proc=os.cpu_count(),
+            # Image files are a side effect of the map, so never replay it from the cache.
+            load_from_cache_file=False,
+        )
+    split_ds.to_json(split_path, lines=True, batch_size=1000, force_ascii=False)
+
+
+def _write_jsonl_rows(
+    split_ds: IterableDataset,
+    split_path: Path,
+    image_dir: Optional[Path],
+) -> None:
+    """
+    Row-by-row writer for streaming datasets, which have no native JSON export.
+    """
+    buffer = bytearray()
+    created_dirs: Set[Path] = set()
+    image_writes: List[Future] = []
+    with split_path.open("wb") as f, ThreadPoolExecutor(max_workers=IMAGE_WRITE_WORKERS) as executor:
+        # Streaming datasets yield a fresh dict per row, so rows are rewritten in place rather than copied.
         for idx, row in enumerate(split_ds):
-            row = dict(row)
             if image_dir and isinstance(row.get("image"), dict):
                 image_info = row["image"]
                 image_name = image_info.get("path") or f"image_{idx}.jpg"
                 image_out = image_dir / image_name
-                image_out.parent.mkdir(parents=True, exist_ok=True)
-                if image_info.get("bytes") and not image_out.exists():
-                    with image_out.open("wb") as img_f:
-                        img_f.write(image_info["bytes"])
+                if image_out.parent not in created_dirs:
+                    image_out.parent.mkdir(parents=True, exist_ok=True)
+                    created_dirs.add(image_out.parent)
+                if image_info.get("bytes"):
+                    image_writes.append(executor.submit(_write_image_bytes, image_out, image_info["bytes"]))
                 # Store relative path in JSON for portability.
                 row["image"] = str(image_out.relative_to(split_path.parent))
 
-            clean_row = {k: _clean_value(v) for k, v in row.items()}
-            f.write(json.dumps(clean_row, ensure_ascii=False) + "\n")
+            for key, value in row.items():
+                row[key] = _clean_value(value)
+            # orjson emits UTF-8 directly; cleaning above still matters since it rejects lone surrogates.
+            buffer += orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE)
+            if len(buffer) >= WRITE_BUFFER_BYTES:
+                f.write(buffer)
+                buffer.clear()
+        f.write(buffer)
+
+    # Surface any image write failure.
+    for future in image_writes:
+        future.result()
 
 
 def _load_from_local_cache() -> Optional[Dict[str, Dataset]]: